@@ -3,34 +3,108 @@
 Vercel-compatible | No razorpay package | Direct HTTP calls
 """
 
+import asyncio
 import sqlite3
-import hashlib
 import hmac
 import os
 import base64
-from datetime import datetime
-from contextlib import asynccontextmanager
+import itertools
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 
 import httpx
-from fastapi import FastAPI, HTTPException
+import msgspec
+import orjson
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from pydantic import BaseModel
 
 # ── Config (set these in Vercel environment variables) ───────
 KEY_ID     = os.getenv("RAZORPAY_KEY_ID", "")
 KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET", "")
+KEY_SECRET_BYTES = KEY_SECRET.encode("utf-8")
 DB_PATH    = "/tmp/orders.db"   # /tmp is the only writable path on Vercel
+LOG_LEVEL  = os.getenv("LOG_LEVEL", "WARNING").upper()
+DB_POOL_SIZE = 8
+ORDER_BATCH_WINDOW = 0.005      # seconds to gather concurrent inserts into one commit
+ORDER_BATCH_MAX    = 64
+
+RAZORPAY_API     = "https://api.razorpay.com"
+RAZORPAY_HEADERS = {
+    "Authorization": "Basic " + base64.b64encode(f"{KEY_ID}:{KEY_SECRET}".encode()).decode(),
+    "Content-Type":  "application/json",
+}
+CONFIG_BODY      = orjson.dumps({"key_id": KEY_ID})   # /api/config never changes
+
+
+# ── Logging ──────────────────────────────────────────────────
+# Requests only enqueue records; the listener thread does the stream writes,
+# so a slow stdout never blocks the event loop. At the default WARNING level
+# the happy path logs nothing.
+log = logging.getLogger("rzp")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
 
 
 # ── DB ───────────────────────────────────────────────────────
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+# WAL lets readers run alongside the writer; synchronous=NORMAL is safe under WAL
+DB_WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+)
+DB_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+_db_pool = queue.Queue()        # read-only connections, shared across requests
+_db_writer = None               # SQLite serializes writes, so one is enough
+_db_write_lock = threading.Lock()
+ORDER_COLUMNS = ()              # column names of `orders`, filled by init_db
+
+
+def _connect(mode, **kwargs):
+    conn = sqlite3.connect(
+        f"file:{DB_PATH}?mode={mode}", uri=True, check_same_thread=False, **kwargs
+    )
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+@contextmanager
+def get_db():
+    """Borrow a pooled read-only connection; it never takes the write lock."""
+    conn = _db_pool.get()
+    try:
+        yield conn
+    finally:
+        _db_pool.put(conn)
+
+@contextmanager
+def get_writer():
+    """Use the writer connection; commits on success, rolls back on error."""
+    with _db_write_lock, _db_writer:
+        yield _db_writer
+
 def init_db():
-    with get_db() as conn:
+    global _db_writer, ORDER_COLUMNS
+    # BEGIN IMMEDIATE takes the write lock up front instead of upgrading mid-transaction
+    _db_writer = _connect("rwc", isolation_level="IMMEDIATE")
+    for pragma in DB_WRITER_PRAGMAS:
+        _db_writer.execute(pragma)
+    with get_writer() as conn:
         conn.execute("""
             CREATE TABLE IF NOT EXISTS orders (
                 id                  INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -49,18 +123,173 @@ def init_db():
                 verified_at         TEXT
             )
         """)
-        conn.commit()
+        # Lets ORDER BY created_at DESC LIMIT ? walk the index instead of sorting
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at DESC)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_orders_status_created"
+            " ON orders(status, created_at DESC)"
+        )
+        # razorpay_order_id lookups use the UNIQUE constraint's autoindex;
+        # refresh planner stats so the new indexes get picked
+        conn.execute("ANALYZE")
+        cur = conn.execute("SELECT * FROM orders LIMIT 0")
+        ORDER_COLUMNS = tuple(d[0] for d in cur.description)
+    for _ in range(DB_POOL_SIZE):
+        _db_pool.put(_connect("ro"))
+
+INSERT_ORDER_SQL = """
+    INSERT INTO orders
+      (razorpay_order_id, product, qty, amount_paise,
+       customer_name, customer_email, customer_phone, delivery_address)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _insert_orders(rows):
+    """
+    Insert a batch of orders in one transaction. If the batch fails, retry
+    row by row so one bad row doesn't fail the rest.
+    Returns the exception (or None) for each row.
+    """
+    try:
+        with get_writer() as conn:
+            conn.executemany(INSERT_ORDER_SQL, rows)
+        return [None] * len(rows)
+    except sqlite3.Error:
+        pass
+    errors = []
+    for row in rows:
+        try:
+            with get_writer() as conn:
+                conn.execute(INSERT_ORDER_SQL, row)
+            errors.append(None)
+        except sqlite3.Error as e:
+            errors.append(e)
+    return errors
+
+def close_db():
+    while not _db_pool.empty():
+        _db_pool.get_nowait().close()
+    with _db_write_lock:             # wait out any write still in flight
+        _db_writer.close()
+
+
+# ── Timestamps ───────────────────────────────────────────────
+# Strings are formatted once per wall-clock second and shared by every
+# request in it. The tuple is swapped in one assignment, so a race only
+# means formatting the same second twice.
+_ts_cache = (-1, "", "")        # (epoch second, local ISO, UTC receipt stamp)
+_receipt_seq = itertools.count(1)
+
+def _timestamps():
+    global _ts_cache
+    sec = int(time.time())
+    cached = _ts_cache
+    if cached[0] != sec:
+        cached = _ts_cache = (
+            sec,
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sec)),
+            time.strftime("%Y%m%d%H%M%S", time.gmtime(sec)),
+        )
+    return cached
+
+def now_iso():
+    return _timestamps()[1]
+
+def new_receipt():
+    """
+    Receipt id. The pid keeps gunicorn workers apart and the counter keeps
+    orders within the same second distinct. The pid is read per call, so
+    it stays correct when workers fork after import (--preload).
+    """
+    return f"5am_{_timestamps()[2]}_{os.getpid()}_{next(_receipt_seq)}"
+
+
+# ── Order writer ─────────────────────────────────────────────
+# create_order queues its row and awaits a future. One background task
+# commits everything that arrived within ORDER_BATCH_WINDOW in a single
+# transaction, so a burst of checkouts shares one fsync. On shutdown the
+# lifespan queues _STOP; everything queued before it is still committed.
+_order_queue = None
+_STOP = object()
+
+async def _order_writer():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await _order_queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        await asyncio.sleep(ORDER_BATCH_WINDOW)
+        while len(batch) < ORDER_BATCH_MAX and not _order_queue.empty():
+            item = _order_queue.get_nowait()
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            errors = await loop.run_in_executor(
+                None, _insert_orders, [row for row, _ in batch]
+            )
+        except Exception as e:
+            errors = [e] * len(batch)
+        for (_, fut), err in zip(batch, errors):
+            if fut.done():              # caller went away
+                continue
+            if err is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(err)
+
+async def save_order(row):
+    """Queue an order row and wait until its batch is committed."""
+    fut = asyncio.get_running_loop().create_future()
+    _order_queue.put_nowait((row, fut))
+    await fut
 
 
 # ── Lifespan ─────────────────────────────────────────────────
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global _order_queue
+    _log_listener.start()
     init_db()
+    _order_queue = asyncio.Queue()
+    writer = asyncio.create_task(_order_writer())
+    # One HTTP/2 client per process: concurrent orders multiplex as streams
+    # over a shared keep-alive TLS connection instead of handshaking each time
+    app.state.rzp_http = httpx.AsyncClient(
+        base_url=RAZORPAY_API,
+        http2=True,
+        timeout=httpx.Timeout(10.0, connect=5.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=16,
+            max_connections=32,
+            keepalive_expiry=60.0,
+        ),
+        headers=RAZORPAY_HEADERS,
+    )
     yield
+    # Let the writer commit what's queued, then fail anything that slipped in after
+    _order_queue.put_nowait(_STOP)
+    await writer
+    while not _order_queue.empty():
+        _, fut = _order_queue.get_nowait()
+        if not fut.done():
+            fut.set_exception(RuntimeError("Server shutting down"))
+    await app.state.rzp_http.aclose()
+    close_db()
+    _log_listener.stop()
 
 
 # ── App ──────────────────────────────────────────────────────
-app = FastAPI(title="5 A.M. Assembly API", lifespan=lifespan)
+app = FastAPI(
+    title="5 A.M. Assembly API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -72,7 +301,9 @@ app.add_middleware(
 
 
 # ── Models ───────────────────────────────────────────────────
-class CreateOrderRequest(BaseModel):
+# Decoded straight from the request bytes; bad payloads fail here. (Kept as a
+# comment: msgspec would publish a docstring as the OpenAPI description.)
+class CreateOrderRequest(msgspec.Struct):
     product: str
     qty: int
     amount_paise: int
@@ -81,6 +312,12 @@ class CreateOrderRequest(BaseModel):
     customer_phone: str
     delivery_address: str
 
+    def __post_init__(self):
+        if self.qty < 1 or self.qty > 20:
+            raise ValueError("Quantity must be between 1 and 20")
+        if self.amount_paise <= 0:
+            raise ValueError("Invalid amount")
+
 class VerifyPaymentRequest(BaseModel):
     razorpay_order_id: str
     razorpay_payment_id: str
@@ -94,69 +331,73 @@ def root():
 
 
 @app.get("/api/config")
-def get_config():
+async def get_config():
     """Returns public Razorpay key to the frontend."""
     if not KEY_ID:
         raise HTTPException(500, "RAZORPAY_KEY_ID not set in environment variables")
-    return {"key_id": KEY_ID}
-
-
-@app.post("/api/create-order")
-async def create_order(req: CreateOrderRequest):
+    # Fresh Response around cached bytes: middleware (CORS) edits headers in place
+    return Response(CONFIG_BODY, media_type="application/json")
+
+
+# The body is decoded by msgspec, not FastAPI, so declare its schema for /docs.
+# Inlined: msgspec.json.schema() points into "$defs", which OpenAPI can't resolve.
+CREATE_ORDER_SCHEMA = msgspec.json.schema_components([CreateOrderRequest])[1]["CreateOrderRequest"]
+
+@app.post(
+    "/api/create-order",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": CREATE_ORDER_SCHEMA}},
+            "required": True,
+        }
+    },
+)
+async def create_order(request: Request):
     """
     Step 1 — Create Razorpay order server-side via direct HTTP.
     Returns order_id for the frontend Razorpay Checkout.
     """
     if not KEY_ID or not KEY_SECRET:
         raise HTTPException(500, "Razorpay credentials not set in environment variables")
-    if req.qty < 1 or req.qty > 20:
-        raise HTTPException(400, "Quantity must be between 1 and 20")
-    if req.amount_paise <= 0:
-        raise HTTPException(400, "Invalid amount")
-
-    credentials = base64.b64encode(f"{KEY_ID}:{KEY_SECRET}".encode()).decode()
+    try:
+        req = msgspec.json.decode(await request.body(), type=CreateOrderRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(400, str(e))
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.razorpay.com/v1/orders",
-                headers={
-                    "Authorization": f"Basic {credentials}",
-                    "Content-Type": "application/json",
+        response = await request.app.state.rzp_http.post(
+            "/v1/orders",
+            # Pre-encoded with orjson; Content-Type is set on the client
+            content=orjson.dumps({
+                "amount":   req.amount_paise,
+                "currency": "INR",
+                "receipt":  new_receipt(),
+                "notes": {
+                    "product":  req.product,
+                    "qty":      str(req.qty),
+                    "customer": req.customer_name,
                 },
-                json={
-                    "amount":   req.amount_paise,
-                    "currency": "INR",
-                    "receipt":  f"5am_{datetime.now().strftime('%Y%m%d%H%M%S')}",
-                    "notes": {
-                        "product":  req.product,
-                        "qty":      str(req.qty),
-                        "customer": req.customer_name,
-                    },
-                },
-            )
+            }),
+        )
         if response.status_code != 200:
+            log.warning("Razorpay order failed: %s %s", response.status_code, response.text)
             raise HTTPException(502, f"Razorpay error: {response.text}")
-        rzp_order = response.json()
+        rzp_order = orjson.loads(response.content)
     except HTTPException:
         raise
     except Exception as e:
+        log.warning("Razorpay order request failed: %r", e)
         raise HTTPException(502, f"Order creation failed: {str(e)}")
 
     rzp_order_id = rzp_order["id"]
 
-    with get_db() as conn:
-        conn.execute("""
-            INSERT INTO orders
-              (razorpay_order_id, product, qty, amount_paise,
-               customer_name, customer_email, customer_phone, delivery_address)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            rzp_order_id, req.product, req.qty, req.amount_paise,
-            req.customer_name, req.customer_email,
-            req.customer_phone, req.delivery_address,
-        ))
-        conn.commit()
+    # Group-committed on a worker thread, so the fsync never stalls the loop
+    await save_order((
+        rzp_order_id, req.product, req.qty, req.amount_paise,
+        req.customer_name, req.customer_email,
+        req.customer_phone, req.delivery_address,
+    ))
+    log.info("Order %s created for %s x%d", rzp_order_id, req.product, req.qty)
 
     return {
         "order_id":     rzp_order_id,
@@ -172,18 +413,23 @@ def verify_payment(req: VerifyPaymentRequest):
     Step 4 — Verify Razorpay signature using HMAC SHA256.
     Only marks order as paid if signature is valid.
     """
-    payload      = f"{req.razorpay_order_id}|{req.razorpay_payment_id}"
-    expected_sig = hmac.new(
-        KEY_SECRET.encode("utf-8"),
-        payload.encode("utf-8"),
-        hashlib.sha256
-    ).hexdigest()
-
-    if not hmac.compare_digest(expected_sig, req.razorpay_signature):
+    # Reject malformed signatures before doing any crypto
+    if len(req.razorpay_signature) != 64:
+        raise HTTPException(400, "Payment verification failed — malformed signature")
+    try:
+        client_sig = bytes.fromhex(req.razorpay_signature)
+    except ValueError:
+        raise HTTPException(400, "Payment verification failed — malformed signature")
+
+    payload      = f"{req.razorpay_order_id}|{req.razorpay_payment_id}".encode("utf-8")
+    expected_sig = hmac.digest(KEY_SECRET_BYTES, payload, "sha256")
+
+    if not hmac.compare_digest(expected_sig, client_sig):
+        log.warning("Invalid signature for order %s", req.razorpay_order_id)
         raise HTTPException(400, "Payment verification failed — invalid signature")
 
-    now = datetime.now().isoformat()
-    with get_db() as conn:
+    now = now_iso()
+    with get_writer() as conn:
         conn.execute("""
             UPDATE orders SET
                 razorpay_payment_id = ?,
@@ -192,8 +438,8 @@ def verify_payment(req: VerifyPaymentRequest):
                 verified_at         = ?
             WHERE razorpay_order_id = ?
         """, (req.razorpay_payment_id, req.razorpay_signature, now, req.razorpay_order_id))
-        conn.commit()
 
+    log.info("Order %s paid (%s)", req.razorpay_order_id, req.razorpay_payment_id)
     return {"status": "verified", "payment_id": req.razorpay_payment_id}
 
 
@@ -201,10 +447,11 @@ def verify_payment(req: VerifyPaymentRequest):
 def list_orders(limit: int = 50):
     """View all orders."""
     with get_db() as conn:
+        # sqlite3's statement cache keeps this query prepared
         rows = conn.execute(
             "SELECT * FROM orders ORDER BY created_at DESC LIMIT ?", (limit,)
         ).fetchall()
-    return [dict(r) for r in rows]
+    return [dict(zip(ORDER_COLUMNS, r)) for r in rows]
 
 
 @app.get("/api/orders/{order_id}")
@@ -215,4 +462,12 @@ def get_order(order_id: str):
         ).fetchone()
     if not row:
         raise HTTPException(404, "Order not found")
-    return dict(row)
+    return dict(zip(ORDER_COLUMNS, row))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # "auto" picks uvloop + httptools when installed (not on Windows) and
+    # falls back to the pure-Python asyncio loop and h11 parser otherwise
+    uvicorn.run("main:app", port=8000, loop="auto", http="auto")